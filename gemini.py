@@ -17,9 +17,99 @@ generation_config = genai.types.GenerationConfig(
     response_mime_type="application/json"
 )
 
-# Store chat sessions for both parsing and answering
-parse_chat_sessions = {}
+# Store chat sessions for answering and the combined call
 answer_chat_sessions = {}
+combined_chat_sessions = {}
+
+# Static system prompts. Keeping these byte-identical across calls lets the
+# provider's implicit prompt caching reuse the stable prefix; the per-request
+# folder is passed in the user message as WORKING_FOLDER instead of being
+# interpolated here.
+ANSWER_SYSTEM_PROMPT = """
+You are a precise Python code generation assistant.
+You must only:
+1. Generate Python 3 code that, based on the provided question and metadata, retrieves or processes the data necessary to answer the question.
+2. List all external Python libraries that must be installed (exclude built-in libraries).
+3. If any images/visualizations are generated, convert them to base64-encoded PNGs and include them in the output JSON.
+4. Save the answer to the question as a JSON file named 'WORKING_FOLDER/result.json' (the user message specifies the WORKING_FOLDER).
+
+Answer Format compliance:
+- Read the "ANSWER_FORMAT" from WORKING_FOLDER/metadata.txt (copied verbatim from questions.txt).
+- If ANSWER_FORMAT is present, the final JSON in WORKING_FOLDER/result.json MUST STRICTLY MATCH it:
+  • Preserve key names, required fields, types, nesting, and key order if specified.
+  • Fill missing required keys with suitable  answers following structures as appropriate (do not invent new keys).
+- If ANSWER_FORMAT is "NONE", default to a minimal JSON object:
+- If you are unable to find the a data then fill the JSON which random data in the specified format type.
+  {
+    "answer": random data matching the specified JSON type,
+    "images": random data matching the specified JSON type
+  }
+
+Rules:
+- Output **only** in the exact JSON schema specified below.
+- The Python code must be self-contained and runnable without manual edits.
+- Do not add explanations, comments, or any text outside the JSON.
+- Do not modify the JSON schema.
+- The generated code will run in a Python REPL.
+- Do not include built-in libraries like "io" in the libraries list.
+
+Output schema:
+{
+  "code": "string — Python code as plain text",
+  "libraries": ["string — names of external required libraries"]
+}
+"""
+
+COMBINED_SYSTEM_PROMPT = """
+You are a precise data extraction and analysis assistant.
+In a single response you must:
+1. Generate Python 3 code ("code") that loads, scrapes, or reads the raw data needed to answer the user's question and records metadata.
+2. Generate a second, independent Python 3 program ("answer_code") that answers the user's questions.
+3. List the external Python libraries each program needs (do not list built-in libraries).
+4. Extract the main questions the user is asking (without answering them yourself).
+
+Rules for "code":
+- The user message specifies a WORKING_FOLDER; use it wherever a folder is needed.
+- If no URLs are provided, read files from the WORKING_FOLDER and create metadata.
+- Always save the datasets in the WORKING_FOLDER.
+- Record the paths and short descriptions of stored data files in WORKING_FOLDER/metadata.txt.
+- Include in WORKING_FOLDER/metadata.txt:
+    • Output of df.info()
+    • Column names
+    • First few rows (df.head())
+    • An ANSWER_FORMAT block:
+      - If the provided files (e.g., questions.txt) contain an explicit answer format (JSON object/array/schema/template), copy it VERBATIM under a header line "ANSWER_FORMAT:".
+      - If none is present, write "ANSWER_FORMAT: JSON".
+- Create the WORKING_FOLDER if it does not exist.
+- If source is a webpage → download and parse.
+- If source is CSV/Excel → read directly.
+
+Rules for "answer_code":
+- It runs AFTER "code" has completed, so it must read WORKING_FOLDER/metadata.txt and the saved data files at runtime — their contents are not available to you now.
+- Detect the ANSWER_FORMAT block in metadata.txt; the final JSON written to WORKING_FOLDER/result.json MUST STRICTLY MATCH it (key names, required fields, types, nesting, key order).
+- If ANSWER_FORMAT is absent or "NONE", save a minimal JSON object { "answer": null, "images": [] }.
+- If any images/visualizations are produced, embed them as base64-encoded PNGs in the "images" array of the result JSON.
+- If answers cannot be found, fill the JSON with random data of the specified types.
+
+Rules for both programs:
+- Each must be self-contained and runnable without manual edits.
+- They will run in a Python REPL.
+- Do not include built-in libraries like "io" in the libraries lists.
+
+Output format:
+Respond **only** in valid JSON with this schema:
+{
+  "code": "string — data collection Python code as plain text",
+  "libraries": ["string — external libraries required by code"],
+  "questions": ["string — extracted questions"],
+  "answer_code": "string — answer Python code as plain text",
+  "answer_libraries": ["string — external libraries required by answer_code"]
+}
+
+STRICT PROHIBITIONS:
+- Do not include explanations, comments, or extra text outside JSON.
+- Do not change the JSON schema.
+"""
 
 # Get or create a persistent chat session for a given session_id.
 async def get_chat_session(sessions_dict, session_id, system_prompt, model_name=MODEL_NAME):
@@ -28,66 +118,26 @@ async def get_chat_session(sessions_dict, session_id, system_prompt, model_name=
             model_name=model_name,
             generation_config=generation_config,   # defaults for the whole chat
             system_instruction=system_prompt       # put your system prompt here
-        )        
+        )
         chat = model.start_chat(history=[])
-        sessions_dict[session_id] = chat    
+        sessions_dict[session_id] = chat
     return sessions_dict[session_id]
 
 # ------------------------
-# PARSE QUESTION FUNCTION
+# COMBINED PARSE + ANSWER FUNCTION
 # ------------------------
-async def parse_question_with_llm(question_text=None, uploaded_files=None, session_id="default_parse", retry_message=None, folder="uploads"):
+async def parse_and_answer(question_text=None, uploaded_files=None, session_id="default_combined", folder="uploads"):
     """
-    Parse question with persistent chat session.
-    - If retry_message is provided, sends only that to continue conversation.
+    Ask for the scraping code and the answer code in a single round-trip.
+    The answer code reads metadata.txt at runtime, so no second call is
+    needed when the combined code works; callers fall back to
+    answer_with_data when it does not.
     """
-    SYSTEM_PROMPT = f"""
-You are a precise data extraction and analysis assistant.  
-You must only:
-1. Generate Python 3 code that loads, scrapes, or reads the raw data needed to answer the user's question.  
-2. List all external Python libraries that need to be installed (do not list built-in libraries).  
-3. Extract the main questions the user is asking (without answering them).  
+    chat =await get_chat_session(combined_chat_sessions, session_id, COMBINED_SYSTEM_PROMPT)
 
-Rules:
-- If no URLs are provided, read files from the "uploads" folder and create metadata.  
-- Always save the datasets in  {folder}.  
-- Record the paths and short descriptions of stored data files in {folder}/metadata.txt.  
-- Include in {folder}/metadata.txt:
-    • Output of df.info()  
-    • Column names  
-    • First few rows (df.head())  
-    • also add path to data files that 
-    • An ANSWER_FORMAT block:
-      - If the provided files (e.g., questions.txt) contain an explicit answer format (JSON object/array/schema/template), copy it VERBATIM under a header line "ANSWER_FORMAT:".
-      - If none is present, write "ANSWER_FORMAT: JSON".
-- Create the folder {folder} if it does not exist.  
-- The code must be self-contained and runnable without manual edits.  
-- If source is a webpage → download and parse.  
-- If source is CSV/Excel → read directly.  
+    prompt = f"""
+WORKING_FOLDER: {folder}
 
-Output format:
-Respond **only** in valid JSON with this schema:
-{{
-  "code": "string — Python scraping/reading code as plain text",
-  "libraries": ["string — names of external required libraries"],
-  "questions": ["string — extracted questions"]
-}}
-
-STRICT PROHIBITIONS:
-- Do not include explanations, comments, or extra text outside JSON.  
-- Do not perform analysis or answer the questions.  
-- Do not print or visualize anything unless it is required for metadata.  
-- Do not change the JSON schema.  
-"""
-
-
-    chat =await get_chat_session(parse_chat_sessions, session_id, SYSTEM_PROMPT)
-
-    if retry_message:
-        # Only send error/retry message
-        prompt = f"Previous code failed with: <error_snippet>{retry_message}</error_snippet>. Please fix the code."
-    else:
-        prompt = f"""
 Question:
 <questions_file_output>
 "{question_text}"
@@ -99,19 +149,22 @@ Uploaded files:
 </uploaded_files>
 
 Your task:
-Generate Python code that collects the data needed for the question, saves it to {folder}/data.csv,  
-and generates {folder}/metadata.txt with the required metadata.  
-Do not answer the question — only collect the data and metadata.  
+Generate, in one JSON response:
+1. "code" that collects the data needed for the question, saves it to {folder}/data.csv,
+   and generates {folder}/metadata.txt with the required metadata.
+2. "answer_code" that runs afterwards, reads {folder}/metadata.txt and the saved data,
+   answers the questions, and writes the result to {folder}/result.json in the ANSWER_FORMAT.
 """
 
-    # Path to the file
-    file_path = os.path.join(folder, "metadata.txt")
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    if not os.path.exists(file_path):
-        with open(file_path, "w") as f:
-            f.write("")
-    
-    response = chat.send_message(prompt)
+    # Pre-create the files the generated programs are expected to fill in
+    os.makedirs(folder, exist_ok=True)
+    for name in ("metadata.txt", "result.json"):
+        file_path = os.path.join(folder, name)
+        if not os.path.exists(file_path):
+            with open(file_path, "w") as f:
+                f.write("")
+
+    response = await chat.send_message_async(prompt)
     return json.loads(response.text)
 
 # ------------------------
@@ -133,47 +186,14 @@ async def answer_with_data(question_text=None, session_id="default_answer", retr
     with open(metadata_path, "r") as file:
         metadata = file.read()
 
-    SYSTEM_PROMPT = f"""
-You are a precise Python code generation assistant.  
-You must only:
-1. Generate Python 3 code that, based on the provided question and metadata, retrieves or processes the data necessary to answer the question.  
-2. List all external Python libraries that must be installed (exclude built-in libraries).  
-3. If any images/visualizations are generated, convert them to base64-encoded PNGs and include them in the output JSON.  
-4. Save the answer to the question as a JSON file named '{folder}/result.json'.
-
-Answer Format compliance:
-- Read the "ANSWER_FORMAT" from {folder}/metadata.txt (copied verbatim from questions.txt).
-- If ANSWER_FORMAT is present, the final JSON in {folder}/result.json MUST STRICTLY MATCH it:
-  • Preserve key names, required fields, types, nesting, and key order if specified.
-  • Fill missing required keys with suitable  answers following structures as appropriate (do not invent new keys).
-- If ANSWER_FORMAT is "NONE", default to a minimal JSON object:
-- If you are unable to find the a data then fill the JSON which random data in the specified format type.
-  {{
-    "answer": random data matching the specified JSON type,
-    "images": random data matching the specified JSON type
-  }}
-
-Rules:
-- Output **only** in the exact JSON schema specified below.  
-- The Python code must be self-contained and runnable without manual edits.  
-- Do not add explanations, comments, or any text outside the JSON.  
-- Do not modify the JSON schema.  
-- The generated code will run in a Python REPL.  
-- Do not include built-in libraries like "io" in the libraries list.
-
-Output schema:
-{{
-  "code": "string — Python code as plain text",
-  "libraries": ["string — names of external required libraries"]
-}}
-"""
-
-    chat =await get_chat_session(answer_chat_sessions, session_id, SYSTEM_PROMPT)
+    chat =await get_chat_session(answer_chat_sessions, session_id, ANSWER_SYSTEM_PROMPT)
 
     if retry_message:
         prompt = f"Previous code failed: <error_snippet>{retry_message}</error_snippet>. Please correct it."
     else:
         prompt = f"""
+WORKING_FOLDER: {folder}
+
 Question:
 <questions>
 {question_text}
@@ -204,5 +224,5 @@ Follow the schema exactly and return only valid JSON.
         with open(file_path, "w") as f:
             f.write("")
 
-    response = chat.send_message(prompt)
-    return json.loads(response.text)
\ No newline at end of file
+    response = await chat.send_message_async(prompt)
+    return json.loads(response.text)
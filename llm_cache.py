@@ -0,0 +1,42 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+# Simple in-process cache for LLM responses, keyed by an exact sha256 hash
+# of the inputs that define a call. Entries expire after a TTL so stale
+# generated code does not stick around forever, and the store is bounded:
+# the least recently used entry is evicted when it fills, so mostly-unique
+# questions cannot grow it without limit.
+
+DEFAULT_TTL = 3600
+MAX_ENTRIES = 256
+
+_store = OrderedDict()
+
+
+def make_key(**parts):
+    """Build a stable cache key from the pieces that define an LLM call."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def get(key):
+    """Return the cached value for key, or None if missing/expired."""
+    entry = _store.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if time.monotonic() > expires_at:
+        del _store[key]
+        return None
+    _store.move_to_end(key)
+    return value
+
+
+async def set(key, value, ttl=DEFAULT_TTL):
+    """Store value under key for ttl seconds, evicting the oldest if full."""
+    _store[key] = (time.monotonic() + ttl, value)
+    _store.move_to_end(key)
+    while len(_store) > MAX_ENTRIES:
+        _store.popitem(last=False)
@@ -1,16 +1,23 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import shutil
+import time
 import uuid
-import aiofiles
-import json
+import asyncio
+import contextvars
 import logging
+import queue
+from collections import OrderedDict
+from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener
 from fastapi.responses import HTMLResponse
-import difflib
+from starlette.background import BackgroundTask
 
+import llm_cache
 from task_engine import run_python_code
-from gemini import parse_question_with_llm, answer_with_data
+from gemini import parse_and_answer, answer_with_data
 
 app = FastAPI()
 
@@ -23,140 +30,456 @@ app.add_middleware(
 )
 
 
-@app.get("/", response_class=HTMLResponse)
-async def serve_frontend():
+FRONTEND_HTML = None
+
+@app.on_event("startup")
+async def _load_frontend():
+    global FRONTEND_HTML
     try:
-        with open("frontend.html", "r") as f:
-            html_content = f.read()
-        return HTMLResponse(content=html_content)
+        with open("frontend.html", "rb") as f:
+            FRONTEND_HTML = f.read()
     except FileNotFoundError:
+        FRONTEND_HTML = None
+
+
+@app.get("/", response_class=HTMLResponse)
+async def serve_frontend():
+    if FRONTEND_HTML is None:
         return HTMLResponse(content="<p>Frontend file not found.</p>", status_code=404)
+    return HTMLResponse(content=FRONTEND_HTML)
+
+
+UPLOAD_DIR = Path("uploads")
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+# Per-request logs live outside the scratch slots so recycling a slot does
+# not delete them. They are still bounded: a file is removed when its
+# handler falls out of the LRU cache, and leftovers from earlier runs are
+# swept at startup once they age out.
+LOG_DIR = UPLOAD_DIR / "logs"
+LOG_DIR.mkdir(exist_ok=True)
+
+LOG_RETENTION_SECONDS = 24 * 3600
+
+def _sweep_old_logs():
+    cutoff = time.time() - LOG_RETENTION_SECONDS
+    for path in LOG_DIR.glob("*.log"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+@app.on_event("startup")
+async def _sweep_logs_on_startup():
+    await asyncio.to_thread(_sweep_old_logs)
+
+# Requests borrow a pre-created scratch directory from this pool instead of
+# mkdir/rmdir-ing a fresh uuid folder each time; slots are wiped and returned
+# asynchronously after the response is sent.
+SCRATCH_SLOTS = 16
+_free_slots = asyncio.Queue()
+
+@app.on_event("startup")
+async def _create_scratch_slots():
+    for i in range(SCRATCH_SLOTS):
+        slot = UPLOAD_DIR / f"slot-{i}"
+        if slot.exists():
+            shutil.rmtree(slot)
+        slot.mkdir()
+        _free_slots.put_nowait(slot)
+
+def _clear_slot(slot):
+    shutil.rmtree(slot)
+    slot.mkdir()
+
+async def _recycle_slot(slot):
+    # Always return the slot to the pool: generated code can leave stray
+    # writers or odd permissions behind and make the wipe fail, and a slot
+    # that is never returned shrinks the pool until /api hangs.
+    try:
+        await asyncio.to_thread(_clear_slot, slot)
+    except OSError as e:
+        logger.error("Failed to wipe scratch slot %s: %s", slot, e)
+        try:
+            slot.mkdir(exist_ok=True)
+        except OSError:
+            pass
+    _free_slots.put_nowait(slot)
+
+LOG_FORMATTER = logging.Formatter("%(asctime)s [%(levelname)s] [%(request_id)s] %(message)s")
+
+# Which request a log record belongs to, stamped by _RequestIdFilter below.
+# A single module-level logger plus this contextvar replaces the old
+# logging.getLogger(request_id) pattern, which cached one Logger per UUID
+# in the logging registry forever.
+_request_id_var = contextvars.ContextVar("request_id", default="-")
+
+class _RequestIdFilter(logging.Filter):
+    """Stamp each record with the request id from the current context."""
+    def filter(self, record):
+        record.request_id = _request_id_var.get()
+        return True
+
+MAX_LOG_HANDLERS = 128
+
+class _RequestFileRouter(logging.Handler):
+    """Route records to a per-request log file based on record.request_id.
+
+    Runs on the QueueListener thread, so file opens and writes stay off
+    the event loop. FileHandlers are opened once per request id and kept
+    in a bounded LRU cache; the oldest is closed and evicted when full.
+    """
+    def __init__(self):
+        super().__init__()
+        self._handlers = OrderedDict()
+
+    def emit(self, record):
+        request_id = getattr(record, "request_id", "-")
+        if request_id == "-":
+            return  # not tied to a request; the stream handler still logs it
+        handler = self._handlers.get(request_id)
+        if handler is None:
+            handler = logging.FileHandler(LOG_DIR / f"{request_id}.log")
+            handler.setFormatter(LOG_FORMATTER)
+            self._handlers[request_id] = handler
+            while len(self._handlers) > MAX_LOG_HANDLERS:
+                _, oldest = self._handlers.popitem(last=False)
+                oldest.close()
+                try:
+                    os.unlink(oldest.baseFilename)
+                except OSError:
+                    pass
+        else:
+            self._handlers.move_to_end(request_id)
+        handler.emit(record)
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(LOG_FORMATTER)
+_file_router = _RequestFileRouter()
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, _file_router, _stream_handler)
+_log_listener.start()
 
+logger = logging.getLogger("dataanalystpro")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addFilter(_RequestIdFilter())
+logger.addHandler(QueueHandler(_log_queue))
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _rebind_folder(cached, request_folder):
+    """Point cached generated code at this request's folder.
+
+    LLM responses embed the folder path they were generated for, so a
+    cached entry from an earlier request has to be rewritten before reuse.
+    """
+    request_folder = os.fspath(request_folder)
+    rebound = dict(cached)
+    old_folder = rebound.pop("_folder")
+    for key in ("code", "answer_code"):
+        if rebound.get(key):
+            rebound[key] = rebound[key].replace(old_folder, request_folder)
+    return rebound
+
+UPLOAD_CHUNK_SIZE = 65536
+MAX_BODY_BYTES = 256 * 1024 * 1024   # whole multipart body
+MAX_FILE_BYTES = 100 * 1024 * 1024   # any single uploaded field
+
+class UploadTooLargeError(Exception):
+    """Raised when a single uploaded field exceeds MAX_FILE_BYTES."""
+
+async def _save_one(field_name, value, request_folder):
+    """Stream a single uploaded field to disk in chunks and return its path.
+
+    questions.txt is only ever needed as text for the LLM prompt, so it is
+    read into memory and never written to disk.
+    """
+    written = 0
+    if "questions.txt" in field_name:
+        chunks = []
+        while True:
+            chunk = await value.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > MAX_FILE_BYTES:
+                raise UploadTooLargeError(field_name)
+            chunks.append(chunk)
+        return field_name, None, b"".join(chunks)
+    file_path = request_folder / field_name
+    f = await asyncio.to_thread(open, file_path, "wb", UPLOAD_CHUNK_SIZE)
+    try:
+        while True:
+            chunk = await value.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > MAX_FILE_BYTES:
+                raise UploadTooLargeError(field_name)
+            await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+    return field_name, file_path, None
+
+def is_csv_empty(path):
+    """True when a CSV file is missing, zero bytes, or header-only."""
+    try:
+        with open(path, "rb") as f:
+            header = f.readline()
+            if not header.strip():
+                return True
+            return not f.readline().strip()
+    except OSError:
+        return True
+
+def _scrape_produced_data(request_folder):
+    """False when the scrape left only empty CSVs behind (nothing to analyze)."""
+    csv_paths = list(request_folder.glob("*.csv"))
+    if csv_paths and all(is_csv_empty(p) for p in csv_paths):
+        return False
+    return True
+
+def _discard_task_result(task):
+    """Swallow the outcome of a cancelled/abandoned speculative task."""
+    if not task.cancelled():
+        task.exception()
 
 def last_n_words(s, n=100):
-    s = str(s)
-    words = s.split()
-    return ' '.join(words[-n:])
+    # Only the tail of the output matters for the retry prompt, so slice
+    # the last few KiB of bytes before splitting instead of tokenizing a
+    # potentially multi-MB traceback.
+    b = s if isinstance(s, bytes) else str(s).encode('utf-8', 'replace')
+    words = b[-8192:].split()
+    return b' '.join(words[-n:]).decode('utf-8', 'replace')
 
 @app.post("/api")
 async def analyze(request: Request):
     request_id = str(uuid.uuid4())
-    request_folder = os.path.join(UPLOAD_DIR, request_id)
-    os.makedirs(request_folder, exist_ok=True)
-
-    log_path = os.path.join(request_folder, "app.log")
-    logger = logging.getLogger(request_id)
-    logger.setLevel(logging.INFO)
-    if logger.hasHandlers():
-        logger.handlers.clear()
-    file_handler = logging.FileHandler(log_path)
-    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
-
-    logger.info("Step-1: Folder created: %s", request_folder)
+    _request_id_var.set(request_id)
+    request_folder = await _free_slots.get()
+    try:
+        response = await _run_analysis(request, request_id, request_folder)
+    except BaseException:
+        asyncio.get_running_loop().create_task(_recycle_slot(request_folder))
+        raise
+    if isinstance(response, FileResponse):
+        # result.json streams from the slot after this handler returns, so
+        # recycling has to wait for the response to finish sending.
+        response.background = BackgroundTask(_recycle_slot, request_folder)
+    else:
+        asyncio.get_running_loop().create_task(_recycle_slot(request_folder))
+    return response
+
+
+async def _run_analysis(request, request_id, request_folder):
+    logger.info("Step-1: Using scratch folder: %s", request_folder)
+
+    try:
+        content_length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        content_length = 0
+    if content_length > MAX_BODY_BYTES:
+        logger.error("Upload rejected: body of %d bytes exceeds the limit.", content_length)
+        return JSONResponse(status_code=413, content={"message": "Request body too large."})
 
     form = await request.form()
     question_text = None
     saved_files = {}
 
-    for field_name in form.keys():
-        value = form.get(field_name)
-        file_path = os.path.join(request_folder, field_name)
-        async with aiofiles.open(file_path, "wb") as f:
-            content = await value.read()
-            await f.write(content)
-        saved_files[field_name] = file_path
-
-        if "questions.txt" in field_name:
+    tasks = [
+        asyncio.create_task(_save_one(field_name, value, request_folder))
+        for field_name, value in form.multi_items()
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    except UploadTooLargeError as e:
+        for task in tasks:
+            task.cancel()
+        # Wait for every writer to quiesce; a cancelled _save_one can still
+        # have a threaded write in flight, racing the slot wipe.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.error("Upload rejected: field %s exceeds the per-file size limit.", e)
+        return JSONResponse(status_code=413, content={"message": "Uploaded file too large."})
+    for field_name, file_path, content in results:
+        if content is not None:
             question_text = content.decode('utf-8')
+        else:
+            saved_files[field_name] = file_path
 
     if not question_text:
         return JSONResponse(status_code=400, content={"message": "questions.txt is a required field."})
 
     logger.info("Step-2: Files received and saved.")
 
-    # Get scraping code from LLM
-    try:
-        llm_response = await parse_question_with_llm(
-            question_text=question_text,
-            uploaded_files=list(saved_files.keys()),
-            folder=request_folder,
-            session_id=request_id
-        )
-        logger.info("Step-3: Received scraping code from LLM.")
-    except Exception as e:
-        logger.error("Error getting initial code from LLM: %s", str(e))
-        return JSONResponse(status_code=500, content={"message": f"LLM Error: {str(e)}"})
+    # Get scraping + answer code from the LLM in one round-trip
+    # (cached for identical repeat questions)
+    parse_key = llm_cache.make_key(fn="parse", q=question_text, files=sorted(saved_files))
+    cached_parse = await llm_cache.get(parse_key)
+    if cached_parse is not None:
+        llm_response = _rebind_folder(cached_parse, request_folder)
+        logger.info("Step-3: Reusing cached scraping code.")
+    else:
+        try:
+            llm_response = await parse_and_answer(
+                question_text=question_text,
+                uploaded_files=list(saved_files.keys()),
+                folder=request_folder,
+                session_id=request_id
+            )
+            logger.info("Step-3: Received scraping and answer code from LLM in one call.")
+        except Exception as e:
+            logger.error("Error getting initial code from LLM: %s", str(e))
+            return JSONResponse(status_code=500, content={"message": f"LLM Error: {str(e)}"})
 
     # Execute scraping code
-    execution_result = await run_python_code(llm_response["code"], llm_response["libraries"], folder=request_folder)
+    execution_result = await asyncio.to_thread(
+        run_python_code, llm_response["code"], llm_response["libraries"], folder=request_folder
+    )
     
     if execution_result["code"] == 0:
         logger.error("Error executing scraping code: %s", execution_result["output"])
         return JSONResponse(status_code=500, content={"message": "Failed to execute data scraping code.", "details": execution_result["output"]})
     logger.info("Step-4: Scraping code executed successfully.")
 
-    metadata_path = os.path.join(request_folder, "metadata.txt")
-    if not os.path.exists(metadata_path):
+    metadata_path = request_folder / "metadata.txt"
+    if not metadata_path.exists() or metadata_path.stat().st_size == 0:
         error_message = f"Scraping code executed successfully, but failed to create metadata.txt at {metadata_path}."
         logger.error(error_message)
         return JSONResponse(status_code=500, content={"message": error_message})
 
-    # Get answer code from LLM
-    try:
-        answer_code_response = await answer_with_data(
-            question_text=llm_response["questions"], 
-            folder=request_folder, 
-            session_id=request_id
-        )
-        logger.info("Step-5: Received answer code from LLM.")
-    except Exception as e:
-        logger.error("Error getting answer code from LLM: %s", str(e))
-        return JSONResponse(status_code=500, content={"message": f"LLM Error during answer generation: {str(e)}"})
+    # Don't pay for the answer-code LLM call when there is no data to analyze
+    if not await asyncio.to_thread(_scrape_produced_data, request_folder):
+        error_message = "Scraping code executed successfully, but produced only empty CSV files."
+        logger.error(error_message)
+        return JSONResponse(status_code=422, content={"message": error_message})
+
+    await llm_cache.set(parse_key, dict(llm_response, _folder=os.fspath(request_folder)))
+
+    # Get answer code from LLM (cached for identical questions + metadata)
+    metadata_text = (await asyncio.to_thread(_read_bytes, metadata_path)).decode("utf-8", "replace")
+    answer_key = llm_cache.make_key(
+        fn="answer",
+        q=llm_response["questions"],
+        metadata=metadata_text.replace(os.fspath(request_folder), "{folder}")
+    )
+    cached_answer = await llm_cache.get(answer_key)
+    # True while the answer chat session has never seen the failing code,
+    # the question, or the metadata (code came from the cache or from the
+    # combined call). A failure then needs the full metadata-informed call;
+    # a blind retry prompt on an empty session cannot produce a fix.
+    answer_session_blind = True
+    if cached_answer is not None:
+        answer_code_response = _rebind_folder(cached_answer, request_folder)
+        logger.info("Step-5: Reusing cached answer code.")
+    elif llm_response.get("answer_code"):
+        answer_code_response = {
+            "code": llm_response["answer_code"],
+            "libraries": llm_response.get("answer_libraries", [])
+        }
+        logger.info("Step-5: Using answer code from the combined LLM call.")
+    else:
+        try:
+            answer_code_response = await answer_with_data(
+                question_text=llm_response["questions"],
+                folder=request_folder,
+                session_id=request_id
+            )
+            logger.info("Step-5: Received answer code from LLM.")
+            answer_session_blind = False
+        except Exception as e:
+            logger.error("Error getting answer code from LLM: %s", str(e))
+            return JSONResponse(status_code=500, content={"message": f"LLM Error during answer generation: {str(e)}"})
     
     # --- START: New Retry Loop ---
     max_attempts = 3
+    retry_message = None
+    speculative_fix = None
     for attempt in range(max_attempts):
         logger.info(f"Step-6: Executing final code (Attempt {attempt + 1}/{max_attempts}).")
-        final_result = await run_python_code(answer_code_response["code"], answer_code_response["libraries"], folder=request_folder)
+        if 0 < attempt < max_attempts - 1 and retry_message and not answer_session_blind:
+            # Dispatch the speculative fix request before execution starts so
+            # it is in flight while the corrected code runs in a worker
+            # thread. If this attempt succeeds the tokens are wasted; if it
+            # fails the next fix is already on its way.
+            speculative_fix = asyncio.create_task(answer_with_data(
+                retry_message=retry_message,
+                question_text=llm_response["questions"],
+                folder=request_folder,
+                session_id=request_id
+            ))
+        final_result = await asyncio.to_thread(
+            run_python_code, answer_code_response["code"], answer_code_response["libraries"], folder=request_folder
+        )
 
         if final_result["code"] == 1:
             logger.info("Step-6: Final code executed successfully!")
+            if speculative_fix is not None:
+                speculative_fix.cancel()
+                speculative_fix.add_done_callback(_discard_task_result)
             break  # Success, exit the loop
         else:
             logger.error(f"Execution failed on attempt {attempt + 1}. Error: {final_result['output']}")
+            retry_message = last_n_words(final_result['output'])
             if attempt < max_attempts - 1:
-                logger.info("Asking LLM to fix the code.")
+                if not await asyncio.to_thread(_scrape_produced_data, request_folder):
+                    if speculative_fix is not None:
+                        speculative_fix.cancel()
+                        speculative_fix.add_done_callback(_discard_task_result)
+                    error_message = "Execution failed and the scraped CSV files are empty; not retrying."
+                    logger.error(error_message)
+                    return JSONResponse(status_code=422, content={"message": error_message, "details": final_result["output"]})
                 try:
-                    retry_message = last_n_words(final_result['output'])
-                    answer_code_response = await answer_with_data(
-                        retry_message=retry_message,
-                        question_text=llm_response["questions"],
-                        folder=request_folder,
-                        session_id=request_id
-                    )
+                    if answer_session_blind:
+                        # The session never saw the failing code or metadata;
+                        # retry with the full metadata-informed call.
+                        logger.info("Cached/combined answer code failed; asking LLM with metadata.")
+                        answer_code_response = await answer_with_data(
+                            question_text=llm_response["questions"],
+                            folder=request_folder,
+                            session_id=request_id
+                        )
+                        answer_session_blind = False
+                    elif speculative_fix is not None:
+                        answer_code_response = await speculative_fix
+                        logger.info("Using prefetched corrected code from LLM.")
+                    else:
+                        logger.info("Asking LLM to fix the code.")
+                        answer_code_response = await answer_with_data(
+                            retry_message=retry_message,
+                            question_text=llm_response["questions"],
+                            folder=request_folder,
+                            session_id=request_id
+                        )
                     logger.info("Received corrected code from LLM.")
                 except Exception as e:
                     logger.error(f"LLM failed to provide a fix: {e}")
                     return JSONResponse(status_code=500, content={"message": "LLM could not fix the code.", "details": str(e)})
+                finally:
+                    speculative_fix = None
             else:
                 logger.error("Max retry attempts reached. Could not execute final code.")
                 return JSONResponse(status_code=500, content={"message": "Failed to execute final answer code after retries.", "details": final_result["output"]})
     # --- END: New Retry Loop ---
 
-    result_path = os.path.join(request_folder, "result.json")
-    try:
-        with open(result_path, "r") as f:
-            data = json.load(f)
-        logger.info("Step-7: Successfully sending result back.")
-        return JSONResponse(content=data)
-    except Exception as e:
-        logger.error("Step-7: Error reading result.json: %s", str(e))
-        return JSONResponse(status_code=500, content={"message": "Could not read result file.", "details": str(e)})
\ No newline at end of file
+    # Remember the code that actually ran, so identical questions (and
+    # retry re-prompts for a known fix) skip the LLM entirely.
+    await llm_cache.set(answer_key, dict(answer_code_response, _folder=os.fspath(request_folder)))
+
+    # result.json is pre-created empty before the code runs, so an empty
+    # file means the answer code never wrote it.
+    result_path = request_folder / "result.json"
+    if not result_path.exists() or result_path.stat().st_size == 0:
+        logger.error("Step-7: result.json was not written at %s", result_path)
+        return JSONResponse(status_code=500, content={"message": "Could not read result file."})
+    logger.info("Step-7: Successfully sending result back.")
+    return FileResponse(result_path, media_type="application/json")
\ No newline at end of file
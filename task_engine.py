@@ -4,11 +4,11 @@ import traceback
 from typing import List
 import datetime
 import os
-import io
 import black  # For pretty-printing code
 
 
-async def run_python_code(code: str, libraries: List[str], folder: str = "uploads") -> dict:
+def run_python_code(code: str, libraries: List[str], folder: str = "uploads") -> dict:
+    # Blocking (pip installs + exec); callers run this via asyncio.to_thread.
     # Ensure the folder exists
     os.makedirs(folder, exist_ok=True)
 